@@ -1,38 +1,154 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Request
 from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
+import msgspec
+from llama_cpp import Llama
 import os
-import json
+import orjson
 import re
-from typing import Dict, AsyncGenerator, Optional
-from collections import deque
+import time
+import functools
+import asyncio
+import threading
+import concurrent.futures
+import psutil
+from typing import Dict, AsyncGenerator, List, Optional
+from collections import deque, OrderedDict
+from contextlib import asynccontextmanager
 
-app = FastAPI()
-
-conversation_contexts: Dict[str, deque] = {}
 MAX_CONTEXT_LENGTH = 100
 
-async def load_llama_cpp_model():
-    """Load llama.cpp model asynchronously"""
+class ContextBuffer:
+    """Conversation history kept as one growing byte buffer rather than re-joined every turn"""
+    
+    def __init__(self):
+        self.text = bytearray()
+        self.turn_sizes = deque()
+    
+    def append(self, turn: str):
+        """Add a turn, dropping the oldest once more than MAX_CONTEXT_LENGTH are held"""
+        data = b"\n" + turn.encode("utf-8")
+        self.text += data
+        self.turn_sizes.append(len(data))
+        if len(self.turn_sizes) > MAX_CONTEXT_LENGTH:
+            # Deleting from the front of a bytearray just moves its start offset
+            del self.text[:self.turn_sizes.popleft()]
+
+conversation_contexts: Dict[str, ContextBuffer] = {}
+
+# Static system preambles. The trailing "{context}\nAssistant:" is the only part
+# that changes per request, so it is kept out of these and tokenized separately.
+SYSTEM_PROMPT_STREAM = "<|system|>You are a helpful AI assistant. Give direct, concise answers. Please ensure your responses are well formatted using markdown and newlines. IMPORTANT: You must wrap ONLY your reasoning and planning in <|thinking|> tags, then provide your final answer OUTSIDE the thinking tags. Example format:\n\n<|thinking|>\nLet me think about this step by step...\n</|thinking|>\n\nHere is my final answer without thinking tags.<|end|>"
+SYSTEM_PROMPT_SYNC = "<|system|>You are a helpful AI assistant. Give direct, concise answers. Please ensure your responses are well formatted using markdown and newlines. IMPORTANT: You must wrap ONLY your reasoning and planning in <|thinking|> tags, then provide your final answer OUTSIDE the thinking tags, there MUST ALWAYS be an answer outside the thinking tags. Example format:\n\n<|thinking|>\nLet me think about this step by step...\n</|thinking|>\n\nHere is my final answer without thinking tags.<|end|>"
+
+# llama.cpp keeps a single KV cache, so only one generation may run at a time.
+# model_lock is held by the worker thread for as long as it touches the model,
+# which keeps this true even when a cancelled request stops waiting for its
+# thread; generator_lock queues requests on the event loop so they don't each
+# tie up an executor thread while they wait.
+# The session whose prompt is currently in the cache is tracked so consecutive
+# turns only evaluate the newly appended tokens; other sessions have their KV
+# state saved and are evicted least-recently-used first once their combined
+# size passes LLM_SESSION_CACHE_MB.
+model_lock = threading.Lock()
+generator_lock = asyncio.Lock()
+active_session: Optional[str] = None
+session_states: "OrderedDict[str, object]" = OrderedDict()
+SESSION_CACHE_BYTES = int(os.environ.get("LLM_SESSION_CACHE_MB", "1024")) * 2**20
+
+# Sampling settings for each endpoint, shared by every request. The stop
+# sequences have to stay lists: llama_cpp drops any other sequence type.
+STREAM_GENERATION_KWARGS = {
+    "temperature": 0.3,
+    "top_p": 0.95,
+    "repeat_penalty": 1.1,
+    "stop": ["</s>", "User:", "Assistant:", "<|end|>", "Support:", "support:", "<system", "AI:", 'Answer:', '<|end_of_instruction|>', '</|end|>'],
+    "echo": False,
+    "stream": True,
+}
+SYNC_GENERATION_KWARGS = {
+    "temperature": 0.8,
+    "top_p": 0.95,
+    "repeat_penalty": 1.1,
+    "stop": ["</s>", "User:"],
+    "echo": False,
+}
+
+# Token ids of the system preambles, filled in once the model is loaded
+SYSTEM_TOKENS_STREAM: List[int] = []
+SYSTEM_TOKENS_SYNC: List[int] = []
+
+def env_flag(name: str) -> Optional[bool]:
+    """Read a boolean environment variable, or None when it is unset"""
+    value = os.environ.get(name)
+    if value is None:
+        return None
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+def select_memory_mode(model_path: str):
+    """Choose use_mmap/use_mlock for the model based on free RAM"""
+    # Reading the whole model up front is much faster at inference time than
+    # mmap, which faults weights in page by page, but only when it fits in free
+    # RAM with some headroom. Otherwise mmap lets the OS page weights in and
+    # out as needed instead of pushing the host into swap. mlock is off by
+    # default since pinning a model the host can't spare over-commits memory.
+    model_size = os.path.getsize(model_path)
+    available = psutil.virtual_memory().available
+    use_mmap = model_size >= available * 0.9
+    use_mlock = False
+    
+    no_mmap = env_flag("LLM_NO_MMAP")
+    if no_mmap is not None:
+        use_mmap = not no_mmap
+    mlock = env_flag("LLM_MLOCK")
+    if mlock is not None:
+        use_mlock = mlock
+    
+    print(f"Model size {model_size / 2**30:.1f} GiB, available RAM {available / 2**30:.1f} GiB: "
+          f"use_mmap={use_mmap}, use_mlock={use_mlock}")
+    return use_mmap, use_mlock
+
+# Names of llama.cpp's general.file_type values, for logging
+GGUF_FILE_TYPES = {
+    "0": "F32", "1": "F16", "2": "Q4_0", "3": "Q4_1", "7": "Q8_0", "8": "Q5_0", "9": "Q5_1",
+    "10": "Q2_K", "11": "Q3_K_S", "12": "Q3_K_M", "13": "Q3_K_L", "14": "Q4_K_S",
+    "15": "Q4_K_M", "16": "Q5_K_S", "17": "Q5_K_M", "18": "Q6_K", "32": "BF16",
+}
+# Types that read several times the memory per token of a 4-5 bit K-quant
+WIDE_FILE_TYPES = {"F32", "F16", "BF16", "Q8_0"}
+
+def log_quantization(model):
+    """Print the model's quantization type and warn when it is a wide one"""
+    file_type = model.metadata.get("general.file_type")
+    if file_type is None:
+        return
+    name = GGUF_FILE_TYPES.get(str(file_type), f"type {file_type}")
+    print(f"Model quantization: {name}")
+    if name in WIDE_FILE_TYPES:
+        print(f"Warning: {name} weights are memory-bandwidth bound on CPU; "
+              f"consider a Q4_K_M or Q5_K_S variant for roughly 2x faster generation")
+
+def load_llama_cpp_model():
+    """Load llama.cpp model"""
     try:
-        from llama_cpp import Llama
         model_name = os.environ.get("LLM_MODEL", "phi-3-mini-4k-instruct.Q4_K_M.gguf")
         model_path = os.path.join(os.path.dirname(__file__), "..", "models", model_name)
         
         if not os.path.exists(model_path):
             print(f"Model file not found: {model_path}")
             return None
-            
+        
+        use_mmap, use_mlock = select_memory_mode(model_path)
         model = Llama(
             model_path=model_path,
             n_ctx=4096,  # Increased context window
             n_threads=os.cpu_count() or 4,  # Use all available CPU cores
             verbose=False,
             n_batch=512,  # Batch size for prompt processing
-            use_mmap=True,  # Memory-mapped file for faster loading
-            use_mlock=True,  # Lock model in memory
+            use_mmap=use_mmap,
+            use_mlock=use_mlock,
         )
         print(f"llama.cpp model loaded successfully: {model_name}")
+        log_quantization(model)
         return model
     except Exception as e:
         print(f"llama.cpp model loading failed: {e}")
@@ -44,136 +160,261 @@ print(f"Using backend: {backend}")
 
 generator = None
 
-@app.on_event("startup")
-async def startup_event():
-    global generator
-    generator = await load_llama_cpp_model()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global generator, SYSTEM_TOKENS_STREAM, SYSTEM_TOKENS_SYNC
+    # Loading and warming up the model block for seconds, so they run in a
+    # worker thread rather than on the event loop
+    generator = await asyncio.to_thread(load_llama_cpp_model)
+    if generator is not None:
+        SYSTEM_TOKENS_STREAM = tokenize_system_prompt(SYSTEM_PROMPT_STREAM)
+        SYSTEM_TOKENS_SYNC = tokenize_system_prompt(SYSTEM_PROMPT_SYNC)
+        await asyncio.to_thread(warmup_model)
+    yield
+
+app = FastAPI(lifespan=lifespan)
 
-class InputText(BaseModel):
+def warmup_model():
+    """Run a one-token generation so the first request doesn't pay for page faults"""
+    # A forward pass reads every weight, which pulls a memory-mapped model into
+    # the page cache now instead of during the first user request. Using the
+    # streaming system prompt also leaves it in the KV cache for that request.
+    start = time.perf_counter()
+    generator(SYSTEM_TOKENS_STREAM, max_tokens=1)
+    print(f"Model warmup took {time.perf_counter() - start:.2f}s")
+
+def tokenize_system_prompt(system_prompt: str) -> List[int]:
+    """Tokenize a system preamble once, including the BOS token"""
+    return generator.tokenize(system_prompt.encode("utf-8"), add_bos=True, special=True)
+
+def saved_state_size(state) -> int:
+    """Bytes held by a saved LlamaState: the KV cells plus its token and logit copies"""
+    return state.llama_state_size + state.input_ids.nbytes + state.scores.nbytes
+
+def activate_session(session_id: str):
+    """Swap the model's KV cache over to the given session, saving the current one"""
+    global active_session
+    if active_session == session_id:
+        return
+    if active_session is not None:
+        session_states[active_session] = generator.save_state()
+        session_states.move_to_end(active_session)
+        cached_bytes = sum(saved_state_size(state) for state in session_states.values())
+        while cached_bytes > SESSION_CACHE_BYTES:
+            _, evicted = session_states.popitem(last=False)
+            cached_bytes -= saved_state_size(evicted)
+    # Without a saved state the current cache is left in place; llama.cpp still
+    # reuses whatever prefix it shares with the new prompt (the system preamble)
+    state = session_states.pop(session_id, None)
+    if state is not None:
+        generator.load_state(state)
+    active_session = session_id
+
+def forget_session(session_id: str):
+    """Drop the KV state of a session whose context was cleared"""
+    global active_session
+    with model_lock:
+        session_states.pop(session_id, None)
+        # The cache still holds the old conversation; don't save it under this
+        # session on the next switch
+        if active_session == session_id:
+            active_session = None
+
+def build_prompt_tokens(system_tokens: List[int], context: ContextBuffer) -> List[int]:
+    """Build the full prompt from the cached system tokens and the conversation context"""
+    suffix = bytes(context.text) + b"\nAssistant:"
+    return system_tokens + generator.tokenize(suffix, add_bos=False, special=True)
+
+class InputText(msgspec.Struct):
     prompt: str
     session_id: str = "default"
-    max_tokens: int = None
+    max_tokens: Optional[int] = None
 
-def estimate_response_tokens(prompt: str) -> int:
+input_text_decoder = msgspec.json.Decoder(InputText)
+
+async def parse_input_text(request: Request) -> InputText:
+    """Decode the request body with msgspec instead of Pydantic validation"""
+    try:
+        return input_text_decoder.decode(await request.body())
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+# Upper bound on estimated response tokens
+MAX_RESPONSE_TOKENS = 4096
+
+# (threshold, bonus) steps for prompt length, highest threshold first
+WORD_LENGTH_BONUSES = ((200, 1024), (100, 768), (50, 512), (20, 256))
+CHAR_LENGTH_BONUSES = ((2000, 1024), (1000, 512))
+
+# Keyword groups used to classify prompts, with the extra tokens each one earns
+PROMPT_KEYWORD_BONUSES = (
+    # Code-related prompts need significantly more tokens
+    (('code', 'function', 'script', 'program', 'implement', 'debug', 'refactor', 'class', 'method'), 1536),
+    # Explanation/tutorial prompts need substantial tokens
+    (('explain', 'how to', 'tutorial', 'guide', 'steps', 'walkthrough', 'detail'), 1024),
+    # List/enumeration prompts need good token allocation
+    (('list', 'examples', 'ways', 'methods', 'types', 'table', 'compare', 'options'), 768),
+    # Creative writing needs generous allocation
+    (('story', 'write', 'creative', 'poem', 'essay', 'narrative', 'fiction'), 1024),
+    # Technical analysis needs more tokens
+    (('analyze', 'review', 'assessment', 'evaluation', 'research', 'study'), 1024),
+)
+# Question answering with context
+QUESTION_PREFIXES = ('what', 'why', 'how', 'when', 'where', 'which', 'who')
+
+def length_bonus(length: int, steps) -> int:
+    """Return the bonus of the first step whose threshold the length exceeds"""
+    for threshold, bonus in steps:
+        if length > threshold:
+            return bonus
+    return 0
+
+def compute_response_tokens(prompt: str) -> int:
     """Estimate required tokens based on prompt characteristics and length"""
     # More generous base token count
     base_tokens = 512
     
-    # More sophisticated prompt length analysis
-    prompt_length = len(prompt.split())
-    char_length = len(prompt)
-    
-    # Scale with prompt length (longer prompts usually need longer responses)
-    if prompt_length > 200:
-        base_tokens += 1024
-    elif prompt_length > 100:
-        base_tokens += 768
-    elif prompt_length > 50:
-        base_tokens += 512
-    elif prompt_length > 20:
-        base_tokens += 256
-    
-    # Character-based scaling for very long prompts
-    if char_length > 2000:
-        base_tokens += 1024
-    elif char_length > 1000:
-        base_tokens += 512
+    # Scale with prompt length (longer prompts usually need longer responses),
+    # plus character-based scaling for very long prompts. Counting spaces
+    # approximates the word count without building a list of words.
+    base_tokens += length_bonus(prompt.count(" ") + 1, WORD_LENGTH_BONUSES)
+    base_tokens += length_bonus(len(prompt), CHAR_LENGTH_BONUSES)
     
-    # Adjust based on prompt type with more generous allocations
+    # Adjust based on prompt type; each group counts once, on its first hit
     prompt_lower = prompt.lower()
+    for keywords, bonus in PROMPT_KEYWORD_BONUSES:
+        for keyword in keywords:
+            if keyword in prompt_lower:
+                base_tokens += bonus
+                break
+        # Nothing left to scan for once the cap below is reached
+        if base_tokens >= MAX_RESPONSE_TOKENS:
+            return MAX_RESPONSE_TOKENS
     
-    # Code-related prompts need significantly more tokens
-    code_keywords = ['code', 'function', 'script', 'program', 'implement', 'debug', 'refactor', 'class', 'method']
-    if any(keyword in prompt_lower for keyword in code_keywords):
-        base_tokens += 1536
-    
-    # Explanation/tutorial prompts need substantial tokens
-    explain_keywords = ['explain', 'how to', 'tutorial', 'guide', 'steps', 'walkthrough', 'detail']
-    if any(keyword in prompt_lower for keyword in explain_keywords):
-        base_tokens += 1024
-    
-    # List/enumeration prompts need good token allocation
-    list_keywords = ['list', 'examples', 'ways', 'methods', 'types', 'table', 'compare', 'options']
-    if any(keyword in prompt_lower for keyword in list_keywords):
-        base_tokens += 768
-    
-    # Creative writing needs generous allocation
-    creative_keywords = ['story', 'write', 'creative', 'poem', 'essay', 'narrative', 'fiction']
-    if any(keyword in prompt_lower for keyword in creative_keywords):
-        base_tokens += 1024
-    
-    # Technical analysis needs more tokens
-    analysis_keywords = ['analyze', 'review', 'assessment', 'evaluation', 'research', 'study']
-    if any(keyword in prompt_lower for keyword in analysis_keywords):
-        base_tokens += 1024
-    
-    # Question answering with context
-    qa_keywords = ['what', 'why', 'how', 'when', 'where', 'which', 'who']
-    if any(prompt_lower.startswith(keyword) for keyword in qa_keywords):
+    if prompt_lower.startswith(QUESTION_PREFIXES):
         base_tokens += 512
     
     # Set reasonable limits with much higher caps
-    final_tokens = min(max(base_tokens, 256), 4096)
+    final_tokens = min(max(base_tokens, 256), MAX_RESPONSE_TOKENS)
     return final_tokens
 
-async def generate_sse_stream(session_id: str, user_prompt: str, max_tokens: int = None) -> AsyncGenerator[str, None]:
+# Retries and repeated prompts skip the keyword scan. Very long prompts rarely
+# repeat, so they bypass the cache rather than pin large strings in it.
+cached_response_tokens = functools.lru_cache(maxsize=1024)(compute_response_tokens)
+ESTIMATE_CACHE_MAX_CHARS = 4096
+
+def estimate_response_tokens(prompt: str) -> int:
+    """Estimate required tokens for a prompt, caching results for short prompts"""
+    if len(prompt) < ESTIMATE_CACHE_MAX_CHARS:
+        return cached_response_tokens(prompt)
+    return compute_response_tokens(prompt)
+
+SSE_DONE = b"event: done\ndata: {}\n\n"
+SSE_ERROR = b"event: error\ndata: {}\n\n"
+
+# Frames buffered between the generation thread and the response; a slow client
+# makes the thread wait rather than letting frames pile up in memory
+STREAM_QUEUE_SIZE = 64
+STREAM_END = object()
+
+def encode_chunk(token: str) -> bytes:
+    """Build the SSE data frame for a token"""
+    # Encode newlines as <<NEWLINE>> for frontend processing. str.replace hands
+    # back the same object when there is no newline, so most tokens cost no copy.
+    return b'data: ' + orjson.dumps({'chunk': token.replace('\n', '<<NEWLINE>>')}) + b'\n\n'
+
+def put_frame(frame, loop: asyncio.AbstractEventLoop, frames: asyncio.Queue,
+              cancelled: threading.Event) -> bool:
+    """Queue a frame from the worker thread, returning False once the client has gone"""
+    # Wait in short slices so a thread blocked on a full queue notices a
+    # disconnect even though nothing will read the queue any more
+    future = asyncio.run_coroutine_threadsafe(frames.put(frame), loop)
+    while not cancelled.is_set():
+        try:
+            future.result(timeout=0.1)
+            return True
+        except concurrent.futures.TimeoutError:
+            pass
+    future.cancel()
+    return False
+
+def stream_frames(session_id: str, prompt_tokens: List[int], max_tokens: int,
+                  loop: asyncio.AbstractEventLoop, frames: asyncio.Queue,
+                  cancelled: threading.Event) -> str:
+    """Run a streaming generation in a worker thread, handing SSE frames to the event loop"""
+    full_response = ""
+    try:
+        with model_lock:
+            activate_session(session_id)
+            for output in generator(prompt_tokens, max_tokens=max_tokens, **STREAM_GENERATION_KWARGS):
+                token = output['choices'][0]['text']
+                # Send all tokens, including empty ones (newlines)
+                full_response += token
+                if not put_frame(encode_chunk(token), loop, frames, cancelled):
+                    break
+    finally:
+        put_frame(STREAM_END, loop, frames, cancelled)
+    return full_response
+
+async def generate_sse_stream(session_id: str, user_prompt: str, max_tokens: int = None) -> AsyncGenerator[bytes, None]:
     try:
         if generator is None:
-            yield json.dumps({"error": "Model not loaded. Please check server logs."}) + "\n"
+            yield orjson.dumps({"error": "Model not loaded. Please check server logs."}) + b"\n"
             return
         
         if "clear context" in user_prompt.lower():
-            conversation_contexts[session_id] = deque(maxlen=MAX_CONTEXT_LENGTH)
-            yield f"data: {json.dumps({'chunk': 'Context cleared. Starting fresh conversation.'})}\n\n"
-            yield "event: done\ndata: {}\n\n"
+            conversation_contexts[session_id] = ContextBuffer()
+            await asyncio.to_thread(forget_session, session_id)
+            yield encode_chunk('Context cleared. Starting fresh conversation.')
+            yield SSE_DONE
             return
         
-        if session_id not in conversation_contexts:
-            conversation_contexts[session_id] = deque(maxlen=MAX_CONTEXT_LENGTH)
-        
-        conversation_contexts[session_id].append(f"User: {user_prompt}")
-        
-        # Build proper chat format
-        context = "\n".join(list(conversation_contexts[session_id]))
-        full_prompt = f"<|system|>You are a helpful AI assistant. Give direct, concise answers. Please ensure your responses are well formatted using markdown and newlines. IMPORTANT: You must wrap ONLY your reasoning and planning in <|thinking|> tags, then provide your final answer OUTSIDE the thinking tags. Example format:\n\n<|thinking|>\nLet me think about this step by step...\n</|thinking|>\n\nHere is my final answer without thinking tags.<|end|>\n{context}\nAssistant:"
-        
         # Use provided max_tokens or estimate based on prompt
         if max_tokens is None:
             max_tokens = estimate_response_tokens(user_prompt)
-        full_response = ""
-        for output in generator(
-            full_prompt,
-            max_tokens=max_tokens,
-            temperature=0.3,
-            top_p=0.95,
-            repeat_penalty=1.1,
-            stop=["</s>", "User:", "Assistant:", "<|end|>", "Support:", "support:", "<system", "AI:", 'Answer:', '<|end_of_instruction|>', '</|end|>'],
-            echo=False,
-            stream=True
-        ):
-            token = output['choices'][0]['text']
-            # Send all tokens, including empty ones (newlines)
-            full_response += token
+        # Generation is blocking, so it runs in a worker thread while this
+        # coroutine forwards its frames without holding up the event loop.
+        # The turn is recorded under the lock so a queued request on the same
+        # session builds its prompt after this reply is in the history.
+        async with generator_lock:
+            if session_id not in conversation_contexts:
+                conversation_contexts[session_id] = ContextBuffer()
+            context = conversation_contexts[session_id]
+            context.append(f"User: {user_prompt}")
             
-            # Encode newlines as <<NEWLINE>> for frontend processing
-            encoded_token = token.replace('\n', '<<NEWLINE>>')
-            yield f"data: {json.dumps({'chunk': encoded_token})}\n\n"
+            # Build proper chat format
+            prompt_tokens = build_prompt_tokens(SYSTEM_TOKENS_STREAM, context)
             
-            # Force flush to ensure immediate streaming
-            import asyncio
-            await asyncio.sleep(0)  # Yield control immediately
-        
-        conversation_contexts[session_id].append(f"Assistant: {full_response.strip()}")
+            loop = asyncio.get_running_loop()
+            frames = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+            cancelled = threading.Event()
+            producer = loop.run_in_executor(
+                None, stream_frames, session_id, prompt_tokens, max_tokens, loop, frames, cancelled
+            )
+            finished = False
+            try:
+                while (frame := await frames.get()) is not STREAM_END:
+                    yield frame
+                finished = True
+            finally:
+                if not finished:
+                    # The client went away: tell the thread to stop generating.
+                    # This must not await, since the task may be cancelled
+                    # again; model_lock keeps the next request out until the
+                    # thread has let go of the model.
+                    cancelled.set()
+            full_response = await producer
+            context.append(f"Assistant: {full_response.strip()}")
         
         # Send end marker
-        yield "event: done\ndata: {}\n\n"
+        yield SSE_DONE
             
     except Exception as e:
-        yield f"data: {json.dumps({'error': str(e)})}\n\n"
-        yield "event: error\ndata: {}\n\n"
+        yield b"data: " + orjson.dumps({'error': str(e)}) + b"\n\n"
+        yield SSE_ERROR
 
 @app.post("/generate/")
-async def generate_response(input_text: InputText):
+async def generate_response(input_text: InputText = Depends(parse_input_text)):
     return StreamingResponse(
         generate_sse_stream(input_text.session_id, input_text.prompt, input_text.max_tokens),
         media_type="text/event-stream",
@@ -184,8 +425,14 @@ async def generate_response(input_text: InputText):
         }
     )
 
+def complete_sync(session_id: str, prompt_tokens: List[int], max_tokens: int) -> dict:
+    """Run a non-streaming generation for a session in a worker thread"""
+    with model_lock:
+        activate_session(session_id)
+        return generator(prompt_tokens, max_tokens=max_tokens, **SYNC_GENERATION_KWARGS)
+
 @app.post("/generate-sync/")
-async def generate_response_sync(input_text: InputText):
+async def generate_response_sync(input_text: InputText = Depends(parse_input_text)):
     try:
         if generator is None:
             return "Model not loaded. Please check server logs."
@@ -194,33 +441,29 @@ async def generate_response_sync(input_text: InputText):
         user_prompt = input_text.prompt
         
         if "clear context" in user_prompt.lower():
-            conversation_contexts[session_id] = deque(maxlen=MAX_CONTEXT_LENGTH)
+            conversation_contexts[session_id] = ContextBuffer()
+            await asyncio.to_thread(forget_session, session_id)
             return "Context cleared. Starting fresh conversation."
         
-        if session_id not in conversation_contexts:
-            conversation_contexts[session_id] = deque(maxlen=MAX_CONTEXT_LENGTH)
-        
-        conversation_contexts[session_id].append(f"User: {user_prompt}")
-        
-        # Build proper chat format  
-        context = "\n".join(list(conversation_contexts[session_id]))
-        full_prompt = f"<|system|>You are a helpful AI assistant. Give direct, concise answers. Please ensure your responses are well formatted using markdown and newlines. IMPORTANT: You must wrap ONLY your reasoning and planning in <|thinking|> tags, then provide your final answer OUTSIDE the thinking tags, there MUST ALWAYS be an answer outside the thinking tags. Example format:\n\n<|thinking|>\nLet me think about this step by step...\n</|thinking|>\n\nHere is my final answer without thinking tags.<|end|>\n{context}\nAssistant:"
         max_tokens = input_text.max_tokens or estimate_response_tokens(user_prompt)
-        result = generator(
-            full_prompt,
-            max_tokens=max_tokens,
-            temperature=0.8,
-            top_p=0.95,
-            repeat_penalty=1.1,
-            stop=["</s>", "User:"],
-            echo=False
-        )
-        response = result['choices'][0]['text'].strip()
-        
-        if not response:
-            response = "I'm here to help! What would you like to know?"
-
-        conversation_contexts[session_id].append(f"Assistant: {response}")
+        # The turn is recorded under the lock so a queued request on the same
+        # session builds its prompt after this reply is in the history
+        async with generator_lock:
+            if session_id not in conversation_contexts:
+                conversation_contexts[session_id] = ContextBuffer()
+            context = conversation_contexts[session_id]
+            context.append(f"User: {user_prompt}")
+            
+            # Build proper chat format  
+            prompt_tokens = build_prompt_tokens(SYSTEM_TOKENS_SYNC, context)
+            # Generation blocks for the whole response, so run it in a worker thread
+            result = await asyncio.to_thread(complete_sync, session_id, prompt_tokens, max_tokens)
+            response = result['choices'][0]['text'].strip()
+            
+            if not response:
+                response = "I'm here to help! What would you like to know?"
+            
+            context.append(f"Assistant: {response}")
         return response
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
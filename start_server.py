@@ -4,7 +4,7 @@ import socket
 import sys
 import os
 import argparse
-import glob
+import ctypes
 
 def check_system_requirements():
     """Check if system-level requirements are available"""
@@ -58,14 +58,20 @@ def check_requirements():
         return True
     
     try:
-        import pkg_resources
+        from importlib.metadata import version, PackageNotFoundError
+        from packaging.requirements import Requirement
         with open(requirements_file, 'r') as f:
             requirements = [line.strip() for line in f if line.strip() and not line.startswith('#')]
         
         for requirement in requirements:
+            req = Requirement(requirement)
+            if req.marker and not req.marker.evaluate():
+                continue
             try:
-                pkg_resources.require(requirement)
-            except (pkg_resources.DistributionNotFound, pkg_resources.VersionConflict):
+                installed = version(req.name)
+            except PackageNotFoundError:
+                return False
+            if req.specifier and not req.specifier.contains(installed, prereleases=True):
                 return False
         return True
     except Exception:
@@ -103,11 +109,18 @@ def get_local_ip():
 
 def detect_gpu():
     """Detect if GPU is available"""
-    try:
-        import torch
-        return torch.cuda.is_available() and torch.cuda.device_count() > 0
-    except:
-        return False
+    # Ask the CUDA driver directly; importing torch just for this takes seconds
+    for lib_name in ("libcuda.so.1", "libcuda.so", "nvcuda.dll"):
+        try:
+            cuda = ctypes.CDLL(lib_name)
+        except OSError:
+            continue
+        count = ctypes.c_int()
+        if cuda.cuInit(0) != 0 or cuda.cuDeviceGetCount(ctypes.byref(count)) != 0:
+            return False
+        return count.value > 0
+    # Without the driver library torch couldn't see a GPU either
+    return False
 
 def get_backend_choice(backend_arg):
     """Determine which backend to use based on argument and GPU availability"""
@@ -121,9 +134,13 @@ def scan_models():
     if not os.path.exists(models_dir):
         return []
     
-    # Look for .gguf files
-    gguf_files = glob.glob(os.path.join(models_dir, "*.gguf"))
-    return [os.path.basename(f) for f in gguf_files]
+    # Look for .gguf files, skipping hidden ones as glob did (e.g. macOS "._"
+    # files); scandir gets file types from the directory listing itself
+    with os.scandir(models_dir) as entries:
+        return [
+            entry.name for entry in entries
+            if entry.name.endswith(".gguf") and not entry.name.startswith(".") and entry.is_file()
+        ]
 
 def select_model(models, no_choice=False):
     """Allow user to select a model from available models"""
@@ -160,6 +177,8 @@ def main():
     parser.add_argument("--port", type=int, default=8004, help="Port to run server on")
     parser.add_argument("--host", default="0.0.0.0", help="Host to bind to")
     parser.add_argument("--no-choice", action="store_true", help="Auto-select first available model")
+    parser.add_argument("--no-mmap", action="store_true", help="Read the whole model into RAM instead of memory-mapping it")
+    parser.add_argument("--mlock", action="store_true", help="Lock the model in RAM so it is never swapped out")
     
     args = parser.parse_args()
     
@@ -207,6 +226,10 @@ def main():
         # Set environment variables for backend and model selection
         os.environ["LLM_BACKEND"] = backend
         os.environ["LLM_MODEL"] = selected_model
+        if args.no_mmap:
+            os.environ["LLM_NO_MMAP"] = "1"
+        if args.mlock:
+            os.environ["LLM_MLOCK"] = "1"
         
         # Start the uvicorn server
         subprocess.run([